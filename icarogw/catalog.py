@@ -6,8 +6,14 @@ import healpy as hp
 import h5py
 import matplotlib.pyplot as plt
 from tqdm import tqdm
+from functools import partial
+import multiprocessing
 
 LOWERL=np.nan_to_num(-np.inf)
+# Gauss-Legendre nodes and weights in [-1,1] used to normalize the gaussian EM likelihood
+GL_NODES,GL_WEIGHTS=[np2cp(v) for v in np.polynomial.legendre.leggauss(100)]
+# Maximum number of elements of the (galaxies, z_grid) arrays used to calculate the interpolant, about 16 MB each in float64
+MAX_BLOCK_ELEMENTS=2**21
 
 def user_normal(x,mu,sigma):
     ''' 
@@ -25,86 +31,314 @@ def user_normal(x,mu,sigma):
     '''
     return xp.power(2*xp.pi*(sigma**2),-0.5)*xp.exp(-0.5*xp.power((x-mu)/sigma,2.))
 
-def EM_likelihood_prior_differential_volume(z,zobs,sigmaz,cosmology,Numsigma=1.,ptype='uniform'):
+def uniform_EM_support(z,zobs,sigmaz,Numsigma=1.):
+    ''' 
+    A utility function meant only for this module. Finds the points of z inside the support of the uniform EM likelihood
+    of each galaxy, i.e. between zobs-Numsigma*sigmaz and zobs+Numsigma*sigmaz
+    
+    Parameters
+    ----------
+    z: xp.array
+        Sorted array of redshifts
+    zobs: xp.array 
+        Central values of the galaxies redshift
+    sigmaz: xp.array
+        Half-width of the galaxies redshift localization in units of Numsigma
+    Numsigma: float
+        Half Width for the uniform distribution method in terms of sigmaz
+    
+    Returns
+    -------
+    rows, cols: xp.array
+        Index of the galaxy and index of z for all the points inside the supports
+    
+    '''
+    # Since z is sorted, the support of each galaxy is the slice z[low:high]
+    low=xp.searchsorted(z,zobs-Numsigma*sigmaz,side='left')
+    high=xp.searchsorted(z,zobs+Numsigma*sigmaz,side='right')
+    lens=xp.maximum(high-low,0)
+    # The indices are built with searchsorted since CuPy does not accept an array of repeats
+    ends=xp.cumsum(lens)
+    k=xp.arange(int(lens.sum()))
+    rows=xp.searchsorted(ends,k,side='right')
+    # Position of each point inside the slice of its galaxy, shifted at the beginning of the slice
+    cols=k-(ends-lens)[rows]+low[rows]
+    return rows,cols
+
+def EM_likelihood_prior_differential_volume(z,zobs,sigmaz,cosmology,Numsigma=1.,ptype='uniform',dVc=None):
     ''' 
     A utility function meant only for this module. Calculates the EM likelihood in redshift times a uniform in comoving volume prior
+    for a set of galaxies at once.
     
     Parameters
     ----------
     z: xp.array
         Values at which to evaluate the EM likelihood times the prior. This is usually and array that starts from 0 and goes to zcut
-    zobs: float 
-        Central value of the galaxy redshift
-    sigmaobs: float
-        Std of galaxy redshift localization. Note if flat EM likelihood sigma is the half-widht of the box distribution.
+    zobs: xp.array 
+        Central values of the galaxies redshift
+    sigmaobs: xp.array
+        Std of galaxies redshift localization. Note if flat EM likelihood sigma is the half-widht of the box distribution.
     cosmology: Class
         Cosmology class from icarogw
     Numsigma: float
         Half Width for the uniform distribution method in terms of sigmaz
     ptype: string
         Type of EM likelihood, ''uniform'' for uniform distribution, ''gaussian'' for gaussian
+    dVc: xp.array
+        Differential of the comoving volume already calculated on z
     
     Returns
     -------
-    Values of the EM likelihood times the prior evaluated on z
+    Values of the EM likelihood times the prior evaluated on z, array of shape (len(zobs),len(z)). For the uniform EM likelihood 
+    the values are zero outside the galaxy supports, only the values inside the supports are returned together with the 
+    index of the galaxy and the index of z of each value (values, rows, cols)
     
     '''
     
+    if dVc is None:
+        dVc=cosmology.dVc_by_dzdOmega_at_z(z)
+    
+    # Galaxies are along the first axis, z along the second one
+    zobs=xp.atleast_1d(zobs)[:,None]
+    sigmaz=xp.atleast_1d(sigmaz)[:,None]
+    
     # Lower limit for the integration. A galaxy must be at a positive redshift
-    zvalmin=xp.array([1e-6,zobs-Numsigma*sigmaz]).max()
+    zvalmin=xp.maximum(1e-6,zobs-Numsigma*sigmaz)
     #zvalmax=xp.array([z.max(),zobs+Numsigma*sigmaz]).min()    
     
     if ptype=='uniform':
         
         # higher limit for the integration. If it is localized  partialy above z_cut, it counts less
         zvalmax=zobs+Numsigma*sigmaz
-        if zvalmax<=zvalmin:
-            return xp.zeros_like(z)
+        valid=xp.where(zvalmax[:,0]>zvalmin[:,0])[0]
+        if len(valid)==0:
+            return xp.zeros(0),valid,valid
+        zobs,sigmaz,zvalmin,zvalmax=zobs[valid],sigmaz[valid],zvalmin[valid],zvalmax[valid]
     
-        prior_eval=4*xp.pi*cosmology.dVc_by_dzdOmega_at_z(z)*((z>=(zobs-Numsigma*sigmaz)) & (z<=(zobs+Numsigma*sigmaz)))/(cosmology.z2Vc(zvalmax)-cosmology.z2Vc(zvalmin))
+        # Only the points of z inside the support of each galaxy are evaluated
+        rows,cols=uniform_EM_support(z,zobs[:,0],sigmaz[:,0],Numsigma)
+        values=4*xp.pi*dVc[cols]/(cosmology.z2Vc(zvalmax[:,0])-cosmology.z2Vc(zvalmin[:,0]))[rows]
+        return values,valid[rows],cols
     elif ptype=='gaussian':
         
         zvalmax=zobs+5.*sigmaz
-        if zvalmax<=zvalmin:
-            return xp.zeros_like(z)
+        prior_eval=xp.zeros([len(zobs),len(z)])
+        valid=xp.where(zvalmax[:,0]>zvalmin[:,0])[0]
+        if len(valid)==0:
+            return prior_eval
+        zobs,sigmaz,zvalmin,zvalmax=zobs[valid],sigmaz[valid],zvalmin[valid],zvalmax[valid]
     
-        prior_eval=cosmology.dVc_by_dzdOmega_at_z(z)*user_normal(z,zobs,sigmaz)
-        zproxy=xp.linspace(zvalmin,zvalmax,5000)
-        normfact=trapz(cosmology.dVc_by_dzdOmega_at_z(zproxy)*user_normal(zproxy,zobs,sigmaz),zproxy)
-        
-        if normfact==0.:
-            print(zobs,sigmaz)
-            raise ValueError('Normalization failed')
-            
-        if np.isnan(normfact):
-            print(zobs,sigmaz)
+        # Gauss-Legendre quadrature between zvalmin and zvalmax, the nodes are the same for all the galaxies
+        halfwidth=0.5*(zvalmax-zvalmin)
+        zproxy=zvalmin+halfwidth*(GL_NODES+1.)
+        normfact=(halfwidth*GL_WEIGHTS*cosmology.dVc_by_dzdOmega_at_z(zproxy)*user_normal(zproxy,zobs,sigmaz)).sum(axis=1)[:,None]
+        
+        failed=(normfact[:,0]==0.) | xp.isnan(normfact[:,0])
+        if failed.any():
+            print(zobs[failed,0],sigmaz[failed,0])
             raise ValueError('Normalization failed')
             
-        prior_eval/=normfact
+        prior_eval[valid,:]=dVc*user_normal(z,zobs,sigmaz)/normfact
         
     elif ptype=='gaussian_nocom':
         
         zvalmax=zobs+5.*sigmaz
-        if zvalmax<=zvalmin:
-            return xp.zeros_like(z)
+        prior_eval=xp.zeros([len(zobs),len(z)])
+        valid=xp.where(zvalmax[:,0]>zvalmin[:,0])[0]
+        if len(valid)==0:
+            return prior_eval
+        zobs,sigmaz,zvalmin,zvalmax=zobs[valid],sigmaz[valid],zvalmin[valid],zvalmax[valid]
     
-        prior_eval=user_normal(z,zobs,sigmaz)
-        zproxy=xp.linspace(zvalmin,zvalmax,5000)
-        normfact=trapz(user_normal(zproxy,zobs,sigmaz),zproxy)
+        # The integral of the gaussian between zvalmin and zvalmax is analytical
+        normfact=0.5*(erf((zvalmax-zobs)/(np.sqrt(2.)*sigmaz))-erf((zvalmin-zobs)/(np.sqrt(2.)*sigmaz)))
         
-        if normfact==0.:
-            print(zobs,sigmaz)
+        failed=(normfact[:,0]==0.) | xp.isnan(normfact[:,0])
+        if failed.any():
+            print(zobs[failed,0],sigmaz[failed,0])
             raise ValueError('Normalization failed')
             
-        if np.isnan(normfact):
-            print(zobs,sigmaz)
-            raise ValueError('Normalization failed')
-            
-        prior_eval/=normfact
+        prior_eval[valid,:]=user_normal(z,zobs,sigmaz)/normfact
 
     return prior_eval
 
+def merge_interpolation_points(zmin,zmax,Nintegration):
+    ''' 
+    A utility function meant only for this module. Builds Nintegration interpolation points in each support [zmin,zmax] and merges 
+    them in a single sorted array. A point is thrown away only if, without it, the gap between the points around it is still smaller than 
+    the spacing (zmax-zmin)/Nintegration of all the supports overlapping the gap. In this way every support keeps at least Nintegration points.
+    
+    Parameters
+    ----------
+    zmin, zmax: np.array
+        Lower and upper limits of the supports
+    Nintegration: int
+        Number of interpolation points in each support
+    
+    Returns
+    -------
+    Sorted array of the interpolation points kept
+    
+    '''
+    z_sorted = np.sort(np.linspace(zmin,zmax,Nintegration,axis=1).ravel())
+    # Spacing required at each point, i.e. the smallest one among all the supports covering the point
+    delta_sorted = covering_minimum(np.searchsorted(z_sorted,zmin,side='left'),np.searchsorted(z_sorted,zmax,side='right'),
+                                    (zmax-zmin)/Nintegration,len(z_sorted))
+    if NUMBA_LOADED:
+        tokeep = thin_sorted_points(z_sorted,delta_sorted)
+    else:
+        # Plain python floats are much faster than numpy scalars in a python loop
+        tokeep = thin_sorted_points(z_sorted.tolist(),delta_sorted.tolist())
+    return z_sorted[tokeep]
+
+def covering_minimum(low,high,vals,npoints):
+    ''' 
+    A utility function meant only for this module. For each of npoints indices, finds the minimum of vals among the ranges [low,high) 
+    containing the index. Each range is split in two overlapping blocks with a power of 2 length, the blocks are then 
+    pushed down from the longest to the shortest length, so that only one array of npoints values is needed.
+    
+    Parameters
+    ----------
+    low, high: np.array
+        Limits of the ranges of indices
+    vals: np.array
+        Value of each range
+    npoints: int
+        Number of indices
+    
+    Returns
+    -------
+    Array with the minimum value of each index, inf if the index is not in any range
+    
+    '''
+    out = np.full(npoints,np.inf)
+    valid = high>low
+    low, high, vals = low[valid], high[valid], vals[valid]
+    if len(vals)==0:
+        return out
+    level = np.floor(np.log2(high-low)).astype(int)
+    for k in range(level.max(),-1,-1):
+        # At this point out[i] is the minimum over the blocks of length 2**k starting at i
+        sel = level==k
+        np.minimum.at(out,low[sel],vals[sel])
+        np.minimum.at(out,high[sel]-2**k,vals[sel])
+        if k>0:
+            out[2**(k-1):] = np.minimum(out[2**(k-1):],out[:-2**(k-1)])
+    return out
+
+@njit
+def thin_sorted_points(z_sorted,delta_sorted):
+    ''' 
+    A utility function meant only for this module. Sequential part of merge_interpolation_points, compiled with numba if available.
+    
+    Parameters
+    ----------
+    z_sorted: np.array
+        Sorted interpolation points
+    delta_sorted: np.array
+        Spacing required at each point
+    
+    Returns
+    -------
+    Boolean mask of the points to keep
+    
+    '''
+    tokeep = np.ones(len(z_sorted),dtype=np.bool_)
+    last = z_sorted[0]
+    # Smallest spacing required between the last point kept and the current point, the points thrown away included
+    delta_min = delta_sorted[0]
+    # This loop is sequential since each point depends on the last point kept
+    for j in range(1,len(z_sorted)-1):
+        delta_gap = min(delta_min,delta_sorted[j],delta_sorted[j+1])
+        if z_sorted[j+1]-last<delta_gap:
+            tokeep[j] = False
+            delta_min = min(delta_min,delta_sorted[j])
+        else:
+            last = z_sorted[j]
+            delta_min = delta_sorted[j]
+    return tokeep
+
+def pixel_dN_by_dzdOmega(gal_data,z_grid,dl_grid,kcorr_grid,dVc_grid,sch_fun,absM_rate,cosmology,Numsigma,ptype,dOmega):
+    ''' 
+    A utility function meant only for this module. Calculates the log of dNgal/dzdOmega in a pixel from its galaxies.
+    This corresponds to Eq. 2.35 on the overleaf document
+    
+    Parameters
+    ----------
+    gal_data: tuple
+        Arrays of apparent magnitudes, redshifts and redshift uncertainties of the galaxies in the pixel
+    z_grid, dl_grid, kcorr_grid, dVc_grid: xp.array
+        Redshift grid of the interpolant and the luminosity distance, k-correction and dVc/dzdOmega evaluated on it
+    sch_fun: class
+        Schechter function class
+    absM_rate: class
+        Absolute magnitude rate class
+    cosmology: class
+        Cosmology class from icarogw
+    Numsigma: float
+        Half Width for the uniform distribution method in terms of sigmaz
+    ptype: string
+        Type of EM likelihood
+    dOmega: float
+        Area of the pixel in sterad
+    
+    Returns
+    -------
+    Log of dNgal/dzdOmega on z_grid as np.float16, NaN where there are no galaxies
+    
+    '''
+    m,zobs,sigmaz = gal_data
+    if len(m)==0:
+        return np.float16(np.nan*np.ones(len(z_grid)))
+    
+    # The galaxies in the pixel are evaluated in blocks, galaxies along the first axis and z_grid along the second.
+    # The blocks are summed on z_grid, so that the memory does not grow with the number of galaxies.
+    m,zobs,sigmaz=np2cp(m),np2cp(zobs),np2cp(sigmaz)
+    block_size=max(1,MAX_BLOCK_ELEMENTS//len(z_grid))
+    interpo=xp.zeros(len(z_grid))
+    for start in range(0,len(m),block_size):
+        mb,zobsb,sigmazb=m[start:start+block_size],zobs[start:start+block_size],sigmaz[start:start+block_size]
+        if ptype=='uniform':
+            # The uniform EM likelihood is zero outside the support of the galaxy, the luminosity weights are calculated only 
+            # inside the supports and summed directly on z_grid
+            prior_eval,rows,cols=EM_likelihood_prior_differential_volume(z_grid,zobsb,sigmazb,cosmology,Numsigma=Numsigma,ptype=ptype,dVc=dVc_grid)
+            Mv=m2M(mb[rows],dl_grid[cols],kcorr_grid[cols])
+            interpo+=xp.bincount(cols,weights=absM_rate.evaluate(sch_fun,Mv)*prior_eval,minlength=len(z_grid))
+        else:
+            prior_eval=EM_likelihood_prior_differential_volume(z_grid,zobsb,sigmazb,cosmology,Numsigma=Numsigma,ptype=ptype,dVc=dVc_grid)
+            Mv=m2M(mb[:,None],dl_grid,kcorr_grid)
+            interpo+=(absM_rate.evaluate(sch_fun,Mv)*prior_eval).sum(axis=0)
+    interpo=cp2np(interpo/dOmega)
+    interpo[interpo==0.]=np.nan
+    return np.float16(np.log(interpo))
+
+def init_pixel_worker(pixel_kwargs):
+    ''' 
+    A utility function meant only for this module. Stores in each worker process the arguments of pixel_dN_by_dzdOmega
+    that are the same for all the pixels, so that they are sent only once and not with every task.
+    
+    Parameters
+    ----------
+    pixel_kwargs: dict
+        Keyword arguments of pixel_dN_by_dzdOmega except gal_data
+    '''
+    global PIXEL_KWARGS
+    PIXEL_KWARGS=pixel_kwargs
+
+def pixel_worker(gal_data):
+    ''' 
+    A utility function meant only for this module. Calls pixel_dN_by_dzdOmega in a worker process initialized with init_pixel_worker.
     
+    Parameters
+    ----------
+    gal_data: tuple
+        Arrays of apparent magnitudes, redshifts and redshift uncertainties of the galaxies in the pixel
+    
+    Returns
+    -------
+    Log of dNgal/dzdOmega on z_grid as np.float16, NaN where there are no galaxies
+    '''
+    return pixel_dN_by_dzdOmega(gal_data,**PIXEL_KWARGS)
+
 def generate_fake_catalog(zmin,zmax,sigmaz,maglim,band,cosmology,outname='fake_cat.hdf5'):
     '''
     Generates a fake catalog
@@ -130,23 +364,32 @@ def generate_fake_catalog(zmin,zmax,sigmaz,maglim,band,cosmology,outname='fake_c
     kcorr_gal=kcorr(band)
     zarr=np.linspace(zmin,zmax,10000)
     dz=zarr[1]-zarr[0]
-    output_dict = {'ra':[],'dec':[],'z':[],'sigmaz':[],'m_'+band:[]}
-    for zz in tqdm(zarr):
-        dVc=(cosmology.dVc_by_dzdOmega_at_z(xp.array([zz+dz]))+cosmology.dVc_by_dzdOmega_at_z(xp.array([zz])))*0.5*dz*xp.pi*4.  
-        Numgal=Numdensity*dVc        
-        Mvals=MF_gal.sample(int(cp2np(Numgal))) 
-        zvals=np.ones_like(Mvals)*zz
-        mvals=M2m(Mvals,cosmology.z2dl(zvals),kcorr_gal(zvals))
-        to_save=np.where(mvals<=maglim)[0]
-        output_dict['ra'].append(np.random.uniform(0,2*np.pi,size=len(to_save)))
-        output_dict['dec'].append(np.arccos(np.random.uniform(-1.,1.,size=len(to_save)))-np.pi/2.)
-        output_dict['z'].append(zvals[to_save])
-        output_dict['sigmaz'].append(np.ones_like(to_save)*sigmaz)
-        output_dict['m_'+band].append(mvals[to_save])
-    
-    for key in output_dict.keys():
-        output_dict[key]=cp2np(np.hstack(output_dict[key]))
-        
+
+    # Number of galaxies in each redshift shell, evaluated on all the shells at once
+    zarr_gpu=np2cp(zarr)
+    dVc=(cosmology.dVc_by_dzdOmega_at_z(zarr_gpu+dz)+cosmology.dVc_by_dzdOmega_at_z(zarr_gpu))*0.5*dz*xp.pi*4.
+    Numgal=cp2np(Numdensity*dVc).astype(int)
+
+    # Draws the absolute magnitudes of all the galaxies together, galaxies are ordered by shell.
+    # The shift from absolute to apparent magnitude is evaluated on the shells and then indexed by the shell of each galaxy,
+    # the apparent magnitudes are calculated in place. The shell indices are built on the host since CuPy does not accept an array of repeats.
+    mvals=MF_gal.sample(int(Numgal.sum()))
+    mvals+=M2m(0.,cosmology.z2dl(zarr_gpu),kcorr_gal(zarr_gpu))[np2cp(np.repeat(np.arange(len(zarr)),Numgal))]
+    to_save=mvals<=maglim
+    mvals=cp2np(mvals[to_save])
+    Nsave=len(mvals)
+
+    # Number of galaxies kept in each shell, only the galaxies kept are placed at the z of their shell
+    kept_cumsum=np.concatenate([[0],np.cumsum(cp2np(to_save))])
+    shell_edges=np.concatenate([[0],np.cumsum(Numgal)])
+    del to_save
+
+    output_dict = {'ra':np.random.uniform(0,2*np.pi,size=Nsave),
+                   'dec':np.arccos(np.random.uniform(-1.,1.,size=Nsave))-np.pi/2.,
+                   'z':np.repeat(zarr,np.diff(kept_cumsum[shell_edges])),
+                   'sigmaz':np.ones(Nsave)*sigmaz,
+                   'm_'+band:mvals}
+
     hf = h5py.File(outname, 'w')
     for key in output_dict.keys():
         hf.create_dataset(key, data=output_dict[key])
@@ -160,7 +403,17 @@ class galaxy_catalog(object):
     
     
     def __init__(self):
-        pass
+        # Columns of the catalog kept in memory, see catalog_columns
+        self.cat_data = None
+    
+    def catalog_columns(self):
+        '''
+        Returns a dictionary with the columns of the catalog as np.arrays. The columns are kept in memory
+        and are read from the HDF5 file only the first time.
+        '''
+        if self.cat_data is None:
+            self.cat_data = {vv:self.hdf5pointer['catalog'][vv][:] for vv in ['ra','dec','z','sigmaz','m','sky_indices']}
+        return self.cat_data
     
     def create_hdf5(self,filename,cat_data,band,nside):
         '''
@@ -203,6 +456,7 @@ class galaxy_catalog(object):
             cat.attrs['Ngal']=len(cat['z'])  
             
         self.hdf5pointer = h5py.File(filename,'r+')
+        self.cat_data = {vv:cat_data[vv] for vv in ['ra','dec','z','sigmaz','m','sky_indices']}
         self.calc_kcorr=kcorr(self.hdf5pointer['catalog'].attrs['band'])
     
     def load_hdf5(self,filename,cosmo_ref=None,epsilon=None):
@@ -220,6 +474,7 @@ class galaxy_catalog(object):
         '''
         
         self.hdf5pointer = h5py.File(filename,'r')
+        self.cat_data = None
         self.sch_fun=galaxy_MF(band=self.hdf5pointer['catalog'].attrs['band'])
         self.calc_kcorr=kcorr(self.hdf5pointer['catalog'].attrs['band'])
         # Stores it internally
@@ -246,18 +501,25 @@ class galaxy_catalog(object):
                 self.hdf5pointer['catalog/dNgal_dzdOm_interpolant'].attrs['epsilon'])
             interpogroup = self.hdf5pointer['catalog/dNgal_dzdOm_interpolant']
             
-            self.dNgal_dzdOm_vals = []
-            for i in range(self.hdf5pointer['catalog'].attrs['npixels']):
-                self.dNgal_dzdOm_vals.append(interpogroup['vals_pixel_{:d}'.format(i)][:])
-            self.dNgal_dzdOm_vals = np.column_stack(self.dNgal_dzdOm_vals)
+            # The log of the interpolant is stored as float16, it is upcasted while reading and exponentiated in place, 
+            # so that only one array is allocated. On the GPU float32 halves the memory, on the CPU float64 is kept
+            # since scipy interpn is slower with float32 values.
+            vals_dtype = np.float32 if CUPY_LOADED else np.float64
+            if 'vals' in interpogroup:
+                self.dNgal_dzdOm_vals = interpogroup['vals'].astype(vals_dtype)[:]
+            else:
+                # Files created with older versions store one dataset per pixel
+                self.dNgal_dzdOm_vals = np.column_stack([interpogroup['vals_pixel_{:d}'.format(i)][:]
+                                                         for i in range(self.hdf5pointer['catalog'].attrs['npixels'])]).astype(vals_dtype)
             self.dNgal_dzdOm_vals = np2cp(self.dNgal_dzdOm_vals)
 
             self.dNgal_dzdOm_vals[xp.isnan(self.dNgal_dzdOm_vals)] = -xp.inf
-            self.dNgal_dzdOm_vals = xp.exp(self.dNgal_dzdOm_vals.astype(float))
+            xp.exp(self.dNgal_dzdOm_vals,out=self.dNgal_dzdOm_vals)
 
             self.dNgal_dzdOm_sky_mean = xp.mean(self.dNgal_dzdOm_vals,axis=1)
+            # z_grid is kept in float64, in float32 close nodes of the grid could become equal
             self.z_grid = np2cp(interpogroup['z_grid'][:])
-            self.pixel_grid = xp.arange(0,self.hdf5pointer['catalog'].attrs['npixels'],1).astype(int)
+            self.pixel_grid = xp.arange(0,self.hdf5pointer['catalog'].attrs['npixels'],1).astype(xp.int32)
             
             print('Loading Galaxy density interpolant')
             
@@ -280,7 +542,10 @@ class galaxy_catalog(object):
         
         if nside_mthr is None:
             nside_mthr = int(self.hdf5pointer['catalog'].attrs['nside'])
-        skypixmthr = radec2indeces(self.hdf5pointer['catalog/ra'][:],self.hdf5pointer['catalog/dec'][:],nside_mthr)
+        cat_data = self.catalog_columns()
+        m = cat_data['m']
+        sky_indices = cat_data['sky_indices']
+        skypixmthr = radec2indeces(cat_data['ra'],cat_data['dec'],nside_mthr)
         npixelsmthr = hp.nside2npix(nside_mthr)
         
         try:
@@ -290,6 +555,8 @@ class galaxy_catalog(object):
             mthgroup.create_dataset('mthr_sky',data=np.nan_to_num(
                 -np.ones(self.hdf5pointer['catalog'].attrs['npixels'])*np.inf))
             indx_sky = 0 # An arra
+            # The checkpoint exists from the beginning, so that an interrupted run can be restarted
+            mthgroup.attrs['sky_checkpoint']=indx_sky
         except:
             mthgroup = self.hdf5pointer['catalog/mthr_map']
             indx_sky = mthgroup.attrs['sky_checkpoint']
@@ -299,25 +566,38 @@ class galaxy_catalog(object):
             # The block below computes the apparent magnitude threshold
             skyloop=np.arange(indx_sky,self.hdf5pointer['catalog'].attrs['npixels'],1).astype(int)
 
-            for indx in tqdm(skyloop,desc='Calculating mthr in pixels'):
-                mthgroup.attrs['sky_checkpoint']=indx
-                rap, decp = indices2radec(indx,self.hdf5pointer['catalog'].attrs['nside'])
-                bigpix = radec2indeces(rap,decp,nside_mthr)               
-                ind=np.where(skypixmthr==bigpix)[0]
-                if ind.size==0:
-                    continue
-                mthgroup['mthr_sky'][indx] = np.percentile(self.hdf5pointer['catalog/m'][ind],
-                                                           mthgroup.attrs['mthr_percentile'])
+            # Sorts the galaxies by pixel and by magnitude inside each pixel, the galaxies in the pixel bigpix are
+            # between boundaries[bigpix] and boundaries[bigpix+1] of the sorted array
+            order=np.lexsort((m,skypixmthr))
+            m_sorted=m[order]
+            boundaries=np.searchsorted(skypixmthr[order],np.arange(npixelsmthr+1))
+            
+            # Percentile in all the pixels with galaxies at once, linear interpolation between ranks as np.percentile
+            mthr_bigpix=np.ones(npixelsmthr)*LOWERL
+            filled=np.where(np.diff(boundaries)>0)[0]
+            starts,lens=boundaries[filled],np.diff(boundaries)[filled]
+            rank=mthgroup.attrs['mthr_percentile']*(lens-1)/100.
+            low=np.floor(rank).astype(int)
+            high=np.minimum(low+1,lens-1)
+            mthr_bigpix[filled]=m_sorted[starts+low]+(rank-low)*(m_sorted[starts+high]-m_sorted[starts+low])
+            
+            # Maps all the sky pixels to the pixels used for the threshold at once
+            rap, decp = indices2radec(skyloop,self.hdf5pointer['catalog'].attrs['nside'])
+            bigpix = radec2indeces(rap,decp,nside_mthr)
+            mthr_sky=mthgroup['mthr_sky'][:]
+            mthr_sky[skyloop] = mthr_bigpix[bigpix]
+            mthgroup['mthr_sky'][:] = mthr_sky
+            mthgroup.attrs['sky_checkpoint']=self.hdf5pointer['catalog'].attrs['npixels']-1
 
 
             # The block below throws away all the galaxies fainter than
             # the apparent magnitude threshold
-            castmthr=mthgroup['mthr_sky'][:][self.hdf5pointer['catalog/sky_indices'][:]]
-            tokeep=np.where(self.hdf5pointer['catalog/m'][:]<=castmthr)[0]
+            castmthr=mthgroup['mthr_sky'][:][sky_indices]
+            tokeep=np.where(m<=castmthr)[0]
             for vv in ['ra','dec','z','sigmaz','m','sky_indices']:
-                tosave=self.hdf5pointer['catalog'][vv][:][tokeep]
+                cat_data[vv]=cat_data[vv][tokeep]
                 del self.hdf5pointer['catalog'][vv]       
-                self.hdf5pointer['catalog'].create_dataset(vv,data=tosave)
+                self.hdf5pointer['catalog'].create_dataset(vv,data=cat_data[vv])
 
             self.hdf5pointer['catalog'].attrs['Ngal']=len(tokeep)
             # Stores it internally
@@ -331,13 +611,8 @@ class galaxy_catalog(object):
         '''
         Returns the galaxy counts in the skymap as np.array
         '''
-        npixels = self.hdf5pointer['catalog'].attrs['Ngal']
-        counts_map = np.zeros(npixels)
-        for indx in range(npixels):
-            ind=np.where(self.hdf5pointer['catalog/sky_indices'][:]==indx)[0]
-            counts_map[indx]=len(ind)
-            if ind.size==0:
-                continue
+        npixels = self.hdf5pointer['catalog'].attrs['npixels']
+        counts_map = np.bincount(self.catalog_columns()['sky_indices'],minlength=npixels).astype(float)
         return counts_map
                 
     def plot_mthr_map(self,**kwargs):
@@ -388,7 +663,7 @@ class galaxy_catalog(object):
         
     def calc_dN_by_dzdOmega_interpolant(self,cosmo_ref,epsilon,
                                         Nintegration=10,Numsigma=1,
-                                        zcut=None,ptype='uniform'):
+                                        zcut=None,ptype='uniform',n_cpu=1):
         '''
         Fits the dNgal/dzdOmega interpolant
         
@@ -406,8 +681,14 @@ class galaxy_catalog(object):
             Redshift where to cut the galaxy catalog, after zcut the completeness is 0
         ptype: string
             'uniform' or 'gaussian' for the EM likelihood type of galaxies
+        n_cpu: int
+            Number of processes used to calculate the pixels in parallel. It is available only with numpy, 
+            since the worker processes cannot share the GPU context of CuPy
         '''
         
+        if (n_cpu>1) & CUPY_LOADED:
+            raise ValueError('The interpolant can be calculated in parallel only with numpy, set n_cpu=1 with CuPy')
+        
         self.sch_fun=galaxy_MF(band=self.hdf5pointer['catalog'].attrs['band'])
         self.sch_fun.build_effective_number_density_interpolant(epsilon)
         
@@ -431,48 +712,28 @@ class galaxy_catalog(object):
         
         self.sch_fun.build_MF(cosmo_ref)
         
-        cat_data=self.hdf5pointer['catalog']
+        cat_data=self.catalog_columns()
+        z_gal, sigmaz_gal, m_gal = cat_data['z'], cat_data['sigmaz'], cat_data['m']
         
         # If zcut is none, it uses the maximum of the cosmology
         if zcut is None:
             zcut = cosmo_ref.zmax
         
         # Selects all the galaxies that have support below zcut and above 1e-6
-        idx_in_range = np.where((cat_data['z'][:]-Numsigma*cat_data['sigmaz'][:]<=zcut) & (cat_data['z'][:]+Numsigma*cat_data['sigmaz'][:]>=1e-6))[0]
+        idx_in_range = np.where((z_gal-Numsigma*sigmaz_gal<=zcut) & (z_gal+Numsigma*sigmaz_gal>=1e-6))[0]
         if len(idx_in_range)==0:
-            raise ValueError('There are no galaxies in the redshift range 1e-6 - {:f}'.format(maxz))
+            raise ValueError('There are no galaxies in the redshift range 1e-6 - {:f}'.format(zcut))
                 
-        interpolation_width = np.empty(len(idx_in_range),dtype=np.float32)
-        j = 0
-        for i in tqdm(idx_in_range,desc='Looping on galaxies to find width'):
-            zmin = np.max([cat_data['z'][i]-Numsigma*cat_data['sigmaz'][i],1e-6])
-            zmax = np.min([cat_data['z'][i]+Numsigma*cat_data['sigmaz'][i],zcut])
-            if zmax>=cosmo_ref.zmax:
-                print(minz,maxz)
-                raise ValueError('The maximum redshift for interpolation is too high w.r.t the cosmology class')        
-            interpolation_width[j]=zmax-zmin
-            j+=1
-            
-        idx_sorted = np.argsort(interpolation_width)
-        del interpolation_width
-        idx_sorted = idx_sorted[::-1] # Decreasing order
-        
-        z_grid = np.linspace(1e-6,zcut,Nintegration)
-        # Note that idx_in_range[idx_sorted] is the label of galaxies such that the 
-        # interpolation width is sorted in decreasing order
-        for i in tqdm(idx_in_range[idx_sorted],desc='Looping galaxies to find array'):
-            zmin = np.max([cat_data['z'][i]-Numsigma*cat_data['sigmaz'][i],1e-6])
-            zmax = np.min([cat_data['z'][i]+Numsigma*cat_data['sigmaz'][i],zcut])
-            zinterpolator = np.linspace(zmin,zmax,Nintegration)
-            delta=(zmax-zmin)/Nintegration
-            z_grid = np.sort(np.hstack([z_grid,zinterpolator]))
-            even_in = np.arange(0,len(z_grid),2)
-            odd_in = np.arange(1,len(z_grid),2)
-            z_even = z_grid[even_in]
-            diffv = np.diff(z_even)
-            to_eliminate = odd_in[np.where(diffv<delta)[0]]
-            z_grid = np.delete(z_grid,to_eliminate)
-            
+        # Support of the galaxies used for the interpolation
+        zmin = np.maximum(z_gal[idx_in_range]-Numsigma*sigmaz_gal[idx_in_range],1e-6)
+        zmax = np.minimum(z_gal[idx_in_range]+Numsigma*sigmaz_gal[idx_in_range],zcut)
+        if zmax.max()>=cosmo_ref.zmax:
+            print(zmin.min(),zmax.max())
+            raise ValueError('The maximum redshift for interpolation is too high w.r.t the cosmology class')        
+        
+        # The interpolation points of all the galaxies, and of the whole range up to zcut, are merged only once
+        z_grid = merge_interpolation_points(np.hstack([1e-6,zmin]),np.hstack([zcut,zmax]),Nintegration)
+        del zmin, zmax
         z_grid = np.unique(z_grid)
              
         absM_rate=log_powerlaw_absM_rate(epsilon=epsilon)
@@ -481,32 +742,51 @@ class galaxy_catalog(object):
         if indx_sky == 0:
             interpogroup.create_dataset('z_grid', data = z_grid)
             interpogroup.create_dataset('pixel_grid', data = np.arange(0,self.hdf5pointer['catalog'].attrs['npixels'],1).astype(int))
+            # Log of the interpolant, one column per pixel. Each chunk contains a block of pixels
+            interpogroup.create_dataset('vals', shape = (len(z_grid),self.hdf5pointer['catalog'].attrs['npixels']),
+                                        dtype = np.float16, chunks = (len(z_grid),min(128,self.hdf5pointer['catalog'].attrs['npixels'])))
         
         skyloop=np.arange(indx_sky,self.hdf5pointer['catalog'].attrs['npixels'],1).astype(int)
-        cpind=cat_data['sky_indices'][:][idx_in_range]    
-        
-        for i in tqdm(skyloop,desc='Calculating interpolant'):
-            interpogroup.attrs['sky_checkpoint']=i
-            gal_index=xp.where(cpind==i)[0]
-            if len(gal_index)==0:
-                tos = np.zeros_like(z_grid)
-                tos[:] = np.nan
-                interpogroup.create_dataset('vals_pixel_{:d}'.format(i), data = tos,dtype = np.float16)
-                del tos
-                continue
-            
-            interpo = 0.
-            
-            for gal in gal_index:
-                # List of galaxy catalog density in increasing order per pixel. This corresponds to Eq. 2.35 on the overleaf document
-                Mv=m2M(cat_data['m'][idx_in_range[gal]],cosmo_ref.z2dl(z_grid),self.calc_kcorr(z_grid))               
-                interpo+=absM_rate.evaluate(self.sch_fun,Mv)*EM_likelihood_prior_differential_volume(z_grid,
-                                                            cat_data['z'][idx_in_range[gal]],cat_data['sigmaz'][idx_in_range[gal]],cosmo_ref
-                                                            ,Numsigma=Numsigma,ptype=ptype)/self.hdf5pointer['catalog'].attrs['dOmega_sterad']
-            
-            interpo[interpo==0.]=np.nan                
-            interpo = np.float16(np.log(interpo))
-            interpogroup.create_dataset('vals_pixel_{:d}'.format(i), data = interpo, dtype = np.float16)
+        cpind=cat_data['sky_indices'][idx_in_range]    
+        
+        # Sorts the galaxies by pixel once, the galaxies in the pixel i are idx_in_range[order[boundaries[i]:boundaries[i+1]]]
+        order=np.argsort(cpind,kind='stable')
+        boundaries=np.searchsorted(cpind[order],np.arange(self.hdf5pointer['catalog'].attrs['npixels']+1))
+        gal_data=((m_gal[gal_labels],z_gal[gal_labels],sigmaz_gal[gal_labels]) for gal_labels in 
+                  (idx_in_range[order[boundaries[i]:boundaries[i+1]]] for i in skyloop))
+        
+        # Quantities on z_grid are the same for all the galaxies, they are calculated only once
+        z_grid_gpu=np2cp(z_grid)
+        pixel_kwargs=dict(z_grid=z_grid_gpu,dl_grid=cosmo_ref.z2dl(z_grid_gpu),
+                          kcorr_grid=self.calc_kcorr(z_grid_gpu),dVc_grid=cosmo_ref.dVc_by_dzdOmega_at_z(z_grid_gpu),
+                          sch_fun=self.sch_fun,absM_rate=absM_rate,cosmology=cosmo_ref,Numsigma=Numsigma,ptype=ptype,
+                          dOmega=self.hdf5pointer['catalog'].attrs['dOmega_sterad'])
+        
+        # Pixels are independent, they can be computed in parallel. The arguments common to all the pixels are given to the 
+        # workers only once. The HDF5 file is written only by this process and in pixel order, so that the checkpoint remains valid.
+        if n_cpu>1:
+            pool=multiprocessing.Pool(n_cpu,initializer=init_pixel_worker,initargs=(pixel_kwargs,))
+            results=pool.imap(pixel_worker,gal_data,chunksize=64)
+        else:
+            pool=None
+            results=map(partial(pixel_dN_by_dzdOmega,**pixel_kwargs),gal_data)
+        
+        try:
+            # The pixels are written one chunk at a time, the checkpoint is the first pixel not written yet
+            interpogroup.attrs['sky_checkpoint']=indx_sky
+            chunk_pixels = interpogroup['vals'].chunks[1]
+            block = []
+            for i,interpo in tqdm(zip(skyloop,results),total=len(skyloop),desc='Calculating interpolant'):
+                block.append(interpo)
+                if ((i+1)%chunk_pixels==0) | (i==skyloop[-1]):
+                    interpogroup['vals'][:,i+1-len(block):i+1] = np.column_stack(block)
+                    interpogroup.attrs['sky_checkpoint']=i+1
+                    block = []
+        finally:
+            # The workers are stopped also if a pixel or the writing fails
+            if pool is not None:
+                pool.terminate()
+                pool.join()
         
         self.hdf5pointer.close()
                 
@@ -528,14 +808,15 @@ class galaxy_catalog(object):
             Use the sky averaged differential of effective number of galaxies in each pixel
         '''
        
+        # Ravel gives views of the inputs when possible, the inputs are never modified below
         originshape=z.shape
-        z=z.flatten()
+        z=xp.ravel(z)
         self.sch_fun.build_MF(cosmology)
-        skypos=skypos.flatten()
+        skypos=xp.ravel(skypos)
         
         if dl is None:
             dl=cosmology.z2dl(z)
-        dl=dl.flatten()
+        dl=xp.ravel(dl)
         
         if isinstance(self.mthr_map, str):
             return xp.zeros(len(z)).reshape(originshape), (self.sch_fun.background_effective_galaxy_density(-xp.inf*xp.ones_like(z))*cosmology.dVc_by_dzdOmega_at_z(z)).reshape(originshape)
@@ -543,15 +824,15 @@ class galaxy_catalog(object):
         Mthr_array=self.calc_Mthr(z,skypos,cosmology,dl=dl)
         # Baiscally tells that if you are above the maximum interpolation range, you detect nothing
         Mthr_array[z>self.z_grid[-1]]=-xp.inf
-        gcpart,bgpart=xp.zeros_like(z),xp.zeros_like(z)
         
         if average:
             gcpart=xp.interp(z,self.z_grid,self.dNgal_dzdOm_sky_mean,left=0.,right=0.)
-        else:        
+        else:
             gcpart=interpn((self.z_grid,self.pixel_grid),self.dNgal_dzdOm_vals,xp.column_stack([z,skypos]),bounds_error=False,
                                 fill_value=0.,method='linear') # If a posterior samples fall outside, then you return 0
         
-        bgpart=self.sch_fun.background_effective_galaxy_density(Mthr_array)*cosmology.dVc_by_dzdOmega_at_z(z)
+        bgpart=self.sch_fun.background_effective_galaxy_density(Mthr_array)
+        bgpart*=cosmology.dVc_by_dzdOmega_at_z(z)
         
         return gcpart.reshape(originshape),bgpart.reshape(originshape)
         
@@ -583,13 +864,15 @@ class galaxy_catalog(object):
             Handle to the axis object
         '''
         
-        gcp,bgp,inco=xp.zeros([len(z),len(radec_indices_list)]),xp.zeros([len(z),len(radec_indices_list)]),xp.zeros([len(z),len(radec_indices_list)])
+        # All the sky positions are evaluated together, z along the first axis and sky positions along the second.
+        # The luminosity distance is the same for all the sky positions
+        zz,skypos=xp.meshgrid(z,np2cp(np.asarray(radec_indices_list)).astype(int),indexing='ij')
+        dl=xp.repeat(cosmology.z2dl(z)[:,None],len(radec_indices_list),axis=1)
         
-        for i,skypos in enumerate(radec_indices_list):
-            gcp[:,i],bgp[:,i]=self.effective_galaxy_number_interpolant(z,skypos*xp.ones_like(z).astype(int),cosmology)
-            Mthr_array=self.calc_Mthr(z,xp.ones_like(z,dtype=int)*skypos,cosmology)
-            Mthr_array[z>self.z_grid[-1]]=-xp.inf
-            inco[:,i]=self.sch_fun.background_effective_galaxy_density(Mthr_array)/self.sch_fun.background_effective_galaxy_density(-xp.ones_like(Mthr_array)*xp.inf)
+        gcp,bgp=self.effective_galaxy_number_interpolant(zz,skypos,cosmology,dl=dl)
+        Mthr_array=self.calc_Mthr(zz,skypos,cosmology,dl=dl)
+        Mthr_array[zz>self.z_grid[-1]]=-xp.inf
+        inco=self.sch_fun.background_effective_galaxy_density(Mthr_array)/self.sch_fun.background_effective_galaxy_density(-xp.ones_like(Mthr_array)*xp.inf)
             
         fig,ax=plt.subplots(2,1,sharex=True)
         
@@ -45,6 +45,17 @@ except ImportError:
         CUPY_LOADED = False
         print('CUPY NOT LOADED BACK TO NUMPY')
 
+
+try:
+    from numba import njit
+    NUMBA_LOADED = True
+except ImportError:
+    NUMBA_LOADED = False
+    def njit(*args,**kwargs):
+        '''Replaces the numba decorator when numba is not installed, the function runs as plain python'''
+        if (len(args)==1) and callable(args[0]):
+            return args[0]
+        return lambda fun: fun
         
 if CUPY_LOADED: 
     def cp2np(array):